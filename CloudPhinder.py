@@ -20,6 +20,8 @@ Options:
    --overwrite                Whether to overwrite pre-existing clouds files
    --units_already_physical   Whether to convert units to physical from comoving
    --max_linking_length=<L>   Maximum radius for neighbor search around a particle [default: 1e100]
+   --size_cutoff=<N>          Number of particles in a group above which it is taken to be unbound without computing its energy [default: 2e5]
+   --bitshuffle               Compress the cloud particle data with bitshuffle+lz4 (needs hdf5plugin, also to read it back) instead of lzf
 """
 
 ## from builtin
@@ -30,10 +32,9 @@ import numpy as np
 from docopt import docopt
 
 from multiprocessing import Pool
-import itertools
 
 ## from here
-from cloudphinder.io_tools import parse_filepath, make_input, read_particle_data, parse_particle_data, computeAndDump, SaveArrayDict
+from cloudphinder.io_tools import parse_filepath, make_input, read_particle_data, parse_particle_data, computeAndDump, SaveArrayDict, snapshot_filesize
 from cloudphinder.clump_tools import ComputeGroups
 
 def CloudPhind(filepath,options,particle_data=None,loud=True):
@@ -82,6 +83,7 @@ def CloudPhind(filepath,options,particle_data=None,loud=True):
             cluster_ngb,
             softening=float(options["--softening"]),
             units_already_physical=bool(options["--units_already_physical"]),
+            nmin=nmin,
             )
 
         ## skip this snapshot, there probably weren't enough particles
@@ -92,10 +94,11 @@ def CloudPhind(filepath,options,particle_data=None,loud=True):
     x,m,rho,
     hsml,u,v,
     zz,sfr) = parse_particle_data(particle_data,nmin,cluster_ngb)
-    phi = np.zeros_like(rho)
 
     if new_particle_data is None: return False
 
+    phi = np.zeros_like(rho)
+
     ## call the cloud finder itself
     groups, bound_groups, assigned_groups = ComputeGroups(
         x,m,rho,
@@ -106,6 +109,7 @@ def CloudPhind(filepath,options,particle_data=None,loud=True):
         nmin=nmin,
         ntree = int(options["--ntree"]),
         alpha_crit=alpha_crit,
+        size_cutoff=float(options["--size_cutoff"]),
         )
 
     ## compute some basic properties of the clouds and dump them and
@@ -117,10 +121,21 @@ def CloudPhind(filepath,options,particle_data=None,loud=True):
         bound_groups,
         hdf5_outfilename,
         dat_outfilename,
-        overwrite)
+        overwrite,
+        bitshuffle=bool(options["--bitshuffle"]))
 
     return True
 
+## CLI options of a pool worker, set once by init_worker rather than pickled with every task
+worker_options = None
+
+def init_worker(options):
+    global worker_options
+    worker_options = options
+
+def CloudPhindWorker(filepath):
+    return CloudPhind(filepath,worker_options)
+
 def main(options):
 
     nproc=int(options["--np"])
@@ -130,9 +145,13 @@ def main(options):
         for f in snappaths:
             CloudPhind(f,options)
     else:
-        argss = zip(snappaths,itertools.repeat(options)) 
-        with Pool(nproc) as my_pool:
-            my_pool.starmap(CloudPhind, argss, chunksize=1)
+        ## start the biggest snapshots first so the slowest tasks don't trail at the end
+        snappaths = sorted(snappaths, key=snapshot_filesize, reverse=True)
+        ## workers are kept for the whole run rather than recycled per snapshot: pytreegrav's tree
+        ##  jitclass can't be cached on disk, so a fresh worker would recompile it every time. the
+        ##  price is that memory a worker grabbed for one snapshot isn't given back to the OS
+        with Pool(nproc, initializer=init_worker, initargs=(options,)) as my_pool:
+            my_pool.map(CloudPhindWorker, snappaths, chunksize=1)
 
 if __name__ == "__main__": 
     options = docopt(__doc__)
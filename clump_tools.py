@@ -1,7 +1,6 @@
 ## from builtin
 from scipy.spatial import cKDTree
-from scipy.spatial.distance import cdist
-from numba import njit
+from numba import njit, prange
 
 from time import time
 
@@ -10,28 +9,50 @@ import numpy as np
 ## from github/mikegrudic
 
 import pytreegrav as pytreegrav
+from pytreegrav.kernel import PotentialKernel
 
 ## global variables
 potential_mode = False
-
-######## Energy functions ######## 
-def KE(c, x, m, h, v, u):
-    """ c - clump index
-        x - 2D array of positions (Nclump,N_this_clump)
-        m - 2D array of masses (Nclump,N_this_clump)
-        h - 2D array of smoothing lengths (Nclump,N_this_clump)
-        v - 2D array of velocities (Nclump,N_this_clump)
-        u - 2D array of internal energies (Nclump,N_this_clump)
+pe_parallel_min = 1000 ## clouds with fewer particles than this get their potential energy on one thread
+NOT_BOUND = np.nan ## group energy of groups past the size cutoff; it survives any sum and fails every avir < alpha_crit test
+
+######## Potential functions ########
+def GatherSoA(x, idx):
+    """ x - 2D array of positions (N,3)
+        idx - indices of the particles to gather
+        returns x[idx] as a C-contiguous (3,len(idx)) array, i.e. one contiguous array per component
     """
-    xc, mc, vc, hc = x[c], m[c], v[c], h[c]
-
-    ## velocity w.r.t. com velocity of clump
-    v_well = vc - np.average(vc, weights=mc,axis=0)
-    vSqr = np.sum(v_well**2,axis=1)
-    return (mc*(vSqr/2 + u[c])).sum()
+    ## gather from the row-major array (one cache line per particle), then transpose the small copy
+    return np.ascontiguousarray(np.take(x, idx, axis=0).T)
 
+@njit(fastmath=True, inline='always', cache=True)
+def SourcePotential(xi, yi, zi, xs, ys, zs, m_source, h_source):
+    phi = 0.
+    for j in range(xs.shape[0]):
+        dx, dy, dz = xs[j] - xi, ys[j] - yi, zs[j] - zi
+        r = np.sqrt(dx*dx + dy*dy + dz*dz)
+        if r == 0:
+            continue ## coincident particles contribute nothing, as in pytreegrav
+        phi += m_source[j]*PotentialKernel(r, h_source[j]) ## -1/r outside the softening
+    return phi
+
+@njit(parallel=True, fastmath=True, cache=True)
+def BruteForceInteractionEnergy(x_target, m_target, xs, ys, zs, m_source, h_source, G=4.301e4):
+    """ x_target, m_target - positions (N_target,3) and masses (N_target) of the targets
+        xs, ys, zs - 1D arrays of source position components (N_source)
+        m_source, h_source - masses and softening lengths of the sources
+        returns sum(m_target*phi_target) without materializing the potential array
+    """
+    energy = 0.
+    for i in prange(x_target.shape[0]):
+        energy += m_target[i]*SourcePotential(
+            x_target[i,0], x_target[i,1], x_target[i,2],
+            xs, ys, zs, m_source, h_source)
+    return G*energy
+
+######## Energy functions ########
 def PE(c, x, m, h, v, u):
-    phic = pytreegrav.Potential(x[c], m[c], h[c], G=4.301e4, theta=0.7)
+    phic = pytreegrav.Potential(x[c], m[c], h[c], G=4.301e4, theta=0.7, parallel=len(m[c]) >= pe_parallel_min)
     return 0.5*(phic*m[c]).sum()
 
 def InteractionEnergy(
@@ -41,7 +62,7 @@ def InteractionEnergy(
     group_b, tree_b,
     particles_not_in_tree_b):
 
-    xb, mb, hb = x[group_b], m[group_b], h[group_b]    
+    xb, mb = x[group_b], m[group_b]
     if tree_a:
         ## evaluate potential from the particles in the tree
         phi = pytreegrav.PotentialTarget(
@@ -51,21 +72,19 @@ def InteractionEnergy(
             tree=tree_a, ## source tree
             G=4.301e4,
             theta=.7)
+        potential_energy = (mb*phi).sum()
 
         ## brute force the particles not in the tree
-        xa, ma, ha = np.take(x, particles_not_in_tree_a,axis=0), np.take(m, particles_not_in_tree_a,axis=0), np.take(h, particles_not_in_tree_a,axis=0)
-        phi += pytreegrav.PotentialTarget_bruteforce(xb, np.zeros(xb.size), xa, ma, ha,G=4.301e4)
+        idx = np.array(particles_not_in_tree_a, dtype=np.intp)
+        xa, ma, ha = GatherSoA(x, idx), m[idx], h[idx]
+        potential_energy += BruteForceInteractionEnergy(xb, mb, *xa, ma, ha)
     else:
         ## have to brute force all the particles
-        xa, ma, ha = x[group_a], m[group_a], h[group_a]        
-        phi = pytreegrav.PotentialTarget_bruteforce(xb, np.zeros(xb.size), xa, ma, ha,G=4.301e4)
-    potential_energy = (mb*phi).sum()
+        idx = np.array(group_a)
+        xa, ma, ha = GatherSoA(x, idx), m[idx], h[idx]
+        potential_energy = BruteForceInteractionEnergy(xb, mb, *xa, ma, ha)
     return potential_energy
     
-def VirialParameter(c, x, m, h, v, u):
-    ke, pe = KE(c,x,m,h,v,u), PE(c,x,m,h,v,u)
-    return(np.abs(2*ke/pe))
-
 ######## Energy increment functions ######## 
 def EnergyIncrement(
     i,
@@ -79,14 +98,17 @@ def EnergyIncrement(
     xtarget = np.array([x[i],])
     if particles_not_in_tree:
         ## have to get potential from particles not in the tree by brute force
-        xa, ma, ha = np.take(x,particles_not_in_tree,axis=0), np.take(m,particles_not_in_tree,axis=0), np.take(h,particles_not_in_tree,axis=0)
-        phi += pytreegrav.PotentialTarget_bruteforce(xtarget, np.zeros(xtarget.size), xa, ma, ha, G=4.301e4)[0]
+        ## convert the index list once rather than once per gathered array
+        idx = np.array(particles_not_in_tree)
+        ma, ha = m[idx], h[idx]
+        phi += 4.301e4 * SourcePotential(x[i,0], x[i,1], x[i,2], *GatherSoA(x, idx), ma, ha)
     if tree:
-        phi += 4.301e4 * pytreegrav.PotentialTarget(
+        phi += pytreegrav.PotentialTarget(
             xtarget,
             None,None, ## source pos and mass
             tree=tree,
-            theta=0.7)
+            G=4.301e4,
+            theta=0.7)[0]
             
     vSqr = np.sum((v[i]-v_com)**2)
     mu = m[i]*M/(m[i]+M)
@@ -107,10 +129,106 @@ def PE_Increment(
     c, m, x, v, u,
     v_com):
 
-    phi = -4.301e4 * np.sum(m[c]/cdist([x[i],],x[c]))
+    dx = x[c] - x[i]
+    phi = -4.301e4 * (m[c]/np.sqrt((dx*dx).sum(axis=1))).sum()
     return m[i]*phi
 
 ######## Grouping functions ######## 
+def SpreadBits(a):
+    """ a - 1D uint64 array of integers < 2**21
+        returns a with two zero bits inserted between each of its bits
+    """
+    a = a & np.uint64(0x1fffff)
+    a = (a | a << np.uint64(32)) & np.uint64(0x1f00000000ffff)
+    a = (a | a << np.uint64(16)) & np.uint64(0x1f0000ff0000ff)
+    a = (a | a << np.uint64(8)) & np.uint64(0x100f00f00f00f00f)
+    a = (a | a << np.uint64(4)) & np.uint64(0x10c30c30c30c30c3)
+    a = (a | a << np.uint64(2)) & np.uint64(0x1249249249249249)
+    return a
+
+def MortonOrder(x):
+    """ x - 2D array of positions (N,3)
+        returns the permutation that sorts the positions along a Morton (Z-order) curve
+    """
+    ## quantize each coordinate onto a 2^21 grid spanning the bounding box
+    xmin = x.min(axis=0)
+    extent = (x.max(axis=0) - xmin).max()
+    scale = (2**21 - 1)/extent if extent > 0 else 0.
+    grid = ((x - xmin)*scale).astype(np.uint64)
+    code = SpreadBits(grid[:,0]) | SpreadBits(grid[:,1]) << np.uint64(1) | SpreadBits(grid[:,2]) << np.uint64(2)
+    return code.argsort()
+
+@njit(cache=True)
+def FindRoot(parent, i):
+    """ parent - union-find parent array, roots are their own parent
+        i - particle index
+        returns the root of i's group, compressing the path along the way
+    """
+    root = i
+    while parent[root] != root:
+        root = parent[root]
+    while parent[i] != root:
+        next_i = parent[i]
+        parent[i] = root
+        i = next_i
+    return root
+
+@njit(cache=True)
+def FindRoots(parent):
+    roots = np.empty_like(parent)
+    for i in range(parent.shape[0]):
+        roots[i] = FindRoot(parent, i)
+    return roots
+
+@njit(cache=True)
+def WeightedMeanUpdate(means, g, values, i, mi, mg):
+    """ means - 2D array of per-group weighted means, updated in place
+        g - index of the group to update, currently of weight mg
+        values - 2D array of per-particle (or per-group) values
+        i - index of the value to add to the mean, of weight mi
+    """
+    for k in range(means.shape[1]):
+        means[g,k] = (mi*values[i,k] + mg*means[g,k])/(mi + mg)
+
+@njit(cache=True)
+def LowerNeighbours(ngb_row, ngbdist_row, phi, i):
+    """ ngb_row, ngbdist_row - neighbour indices and distances of particle i, excluding itself
+        phi - potential (or -density) of all particles
+        returns whether any neighbour is missing, the number of neighbours with lower phi,
+            and the nearest two of those (-1 where there are fewer)
+    """
+    N = phi.shape[0]
+    nlower = 0
+    a, b = -1, -1
+    da, db = np.inf, np.inf
+    for j in range(ngb_row.shape[0]):
+        n = ngb_row[j]
+        if n >= N: ## cKDTree marks neighbours beyond the search radius with N
+            return True, 0, -1, -1
+        if phi[n] < phi[i]:
+            nlower += 1
+            d = ngbdist_row[j]
+            if d < da:
+                b, db = a, da
+                a, da = n, d
+            elif d < db:
+                b, db = n, d
+    return False, nlower, a, b
+
+def GroupTree(group, x, m, h, xbuf, mbuf, hbuf):
+    """ group - list of particle indices in the group
+        x, m, h - positions, masses and softening lengths of all particles
+        xbuf, mbuf, hbuf - scratch buffers at least as long as the group
+        returns a pytreegrav tree of the group's particles
+    """
+    n = len(group)
+    ## gather into the scratch buffers (mode='clip' so take writes to out without
+    ##  buffering); the tree keeps its own copy of the data, so the buffers can be reused
+    return pytreegrav.ConstructTree(
+        np.take(x, group, axis=0, out=xbuf[:n], mode='clip'),
+        np.take(m, group, out=mbuf[:n], mode='clip'),
+        np.take(h, group, out=hbuf[:n], mode='clip'))
+
 def ParticleGroups(
     x, m, rho, phi,
     h, u, v, zz,
@@ -118,27 +236,38 @@ def ParticleGroups(
     ntree,
     alpha_crit,
     cluster_ngb=32,
-    rmax=1e100):
+    rmax=1e100,
+    size_cutoff=2e5):
 
     if not potential_mode: phi = -rho
-    ngbdist, ngb = cKDTree(x).query(x,min(cluster_ngb, len(x)), distance_upper_bound=min(rmax, h.max()))
+    ## query in Morton order so consecutive queries walk overlapping parts of the tree, then
+    ##  scatter the results back to particle order, dropping the first neighbour (the particle itself)
+    order = MortonOrder(x)
+    ## sliding-midpoint splits without node compaction build the tree faster, and the query is threaded
+    tree = cKDTree(x, leafsize=32, balanced_tree=False, compact_nodes=False)
+    query_dist, query_ngb = tree.query(x[order],min(cluster_ngb, len(x)), distance_upper_bound=min(rmax, h.max()), workers=-1)
+    ngbdist, ngb = np.empty_like(query_dist[:,1:]), np.empty_like(query_ngb[:,1:])
+    ngbdist[order], ngb[order] = query_dist[:,1:], query_ngb[:,1:]
 
     max_group_size = 0
     groups = {}
     particles_since_last_tree = {}
     group_tree = {}
     group_alpha_history = {}
-    group_energy = {}
-    group_KE = {}
     group_PE = {}
-    COM = {}
-    v_COM = {}
-    masses = {}
+    ## per-group quantities, indexed by the group's root particle
+    group_energy = np.zeros(len(x))
+    group_KE = np.zeros(len(x))
+    COM = np.zeros_like(x)
+    v_COM = np.zeros_like(v)
+    masses = np.zeros(len(x))
     positions = {}
     softenings = {}
     bound_groups = {}
     bound_subgroups = {}
-    assigned_group = -np.ones(len(x),dtype=np.int32)
+    ## union-find forest over particles; a group's id is its root particle
+    parent = np.arange(len(x),dtype=np.int32)
+    xbuf, mbuf, hbuf = np.empty_like(x), np.empty_like(m), np.empty_like(h)
     
     assigned_bound_group = -np.ones(len(x),dtype=np.int32)
     largest_assigned_group = -np.ones(len(x),dtype=np.int32)
@@ -147,10 +276,10 @@ def ParticleGroups(
         ## do it one particle at a time, in decreasing order of density
         if not i%10000:
             print("Processed %d of %g particles; ~%3.2g%% done."%(i, len(x), 100*(float(i)/len(x))**2))
-        if np.any(ngb[i] > len(x) -1):
+        missing_ngb, nlower, a, b = LowerNeighbours(ngb[i], ngbdist[i], phi, i)
+        if missing_ngb:
             groups[i] = [i,]
             group_tree[i] = None
-            assigned_group[i] = i
             group_energy[i] = m[i]*u[i]
             group_KE[i] = m[i]*u[i]
             v_COM[i] = v[i]
@@ -158,21 +287,10 @@ def ParticleGroups(
             masses[i] = m[i]
             particles_since_last_tree[i] = [i,]
             continue 
-        ngbi = ngb[i][1:]
-
-        lower = phi[ngbi] < phi[i]
-        if lower.sum():
-            ngb_lower, ngbdist_lower = ngbi[lower], ngbdist[i][1:][lower]
-            ngb_lower = ngb_lower[ngbdist_lower.argsort()]
-            nlower = len(ngb_lower)
-        else:
-            nlower = 0
-
         add_to_existing_group = False
         if nlower == 0: # if this is the densest particle in the kernel, let's create our own group with blackjack and hookers
             groups[i] = [i,]
             group_tree[i] = None
-            assigned_group[i] = i
             group_energy[i] = m[i]*u[i]# - 2.8*m[i]**2/h[i] / 2 # kinetic + potential energy
             group_KE[i] = m[i]*u[i]
             v_COM[i] = v[i]
@@ -180,25 +298,23 @@ def ParticleGroups(
             masses[i] = m[i]
             particles_since_last_tree[i] = [i,]
         # if there is only one denser particle, or both of the nearest two denser ones belong to the same group, we belong to that group too
-        elif nlower == 1 or assigned_group[ngb_lower[0]] == assigned_group[ngb_lower[1]]: 
-            assigned_group[i] = assigned_group[ngb_lower[0]]
-            groups[assigned_group[i]].append(i)
+        elif nlower == 1 or FindRoot(parent, a) == FindRoot(parent, b): 
+            parent[i] = FindRoot(parent, a)
+            groups[parent[i]].append(i)
             add_to_existing_group = True
         # o fuck we're at a saddle point, let's consider both respective groups
         else: 
-            a, b = ngb_lower[:2]
-            group_index_a, group_index_b = assigned_group[a], assigned_group[b]
+            group_index_a, group_index_b = FindRoot(parent, a), FindRoot(parent, b)
             # make sure group a is the bigger one, switching labels if needed
             if masses[group_index_a] < masses[group_index_b]: group_index_a, group_index_b = group_index_b, group_index_a 
 
             # if both dense boyes belong to the same group, that's the group for us too
             if group_index_a == group_index_b:  
-                assigned_group[i] = group_index_a
+                parent[i] = group_index_a
             #OK, we're at a saddle point, so we need to merge those groups
             else:
                 group_a, group_b = groups[group_index_a], groups[group_index_b] 
                 ma, mb = masses[group_index_a], masses[group_index_b]
-                xa, xb = COM[group_index_a], COM[group_index_b] 
                 va, vb = v_COM[group_index_a], v_COM[group_index_b]
                 group_ab = group_a + group_b
                 groups[group_index_a] = group_ab
@@ -208,44 +324,44 @@ def ParticleGroups(
                 group_energy[group_index_a] += 0.5*ma*mb/(ma+mb) * np.sum((va-vb)**2) # energy due to relative motion: 1/2 * mu * dv^2
                 group_KE[group_index_a] += 0.5*ma*mb/(ma+mb) * np.sum((va-vb)**2)
 
-                # mutual interaction energy; we've already counted their individual binding energies
-                group_energy[group_index_a] += InteractionEnergy(
-                    x,m,h,
-                    group_a,group_tree[group_index_a],
-                    particles_since_last_tree[group_index_a],
-                    group_b,group_tree[group_index_b],
-                    particles_since_last_tree[group_index_b]) 
-
-
-                # we've got a big group, so we should probably do stuff with the tree
-                if len(group_a) > ntree: 
-                    # if the smaller of the two is also large, let's build a whole new tree, and a whole new adventure
-                    if len(group_b) > 512: 
-                        group_tree[group_index_a] = pytreegrav.ConstructTree(
-                            np.take(x,group_ab,axis=0),
-                            np.take(m,group_ab),
-                            np.take(h,group_ab))
-                        particles_since_last_tree[group_index_a][:] = []
-                    # otherwise we want to keep the old tree from group a, and just add group b to the list of particles_since_last_tree
-                    else:  
-                        particles_since_last_tree[group_index_a] += group_b
+                # groups this large cannot be GMCs, so skip their (most expensive) potential energies and
+                #  trees altogether and just mark them unbound; they only ever grow, so this is for good
+                if len(group_ab) > size_cutoff:
+                    group_energy[group_index_a] = NOT_BOUND
+                    group_tree[group_index_a] = None
+                    particles_since_last_tree[group_index_a][:] = []
                 else:
-                    particles_since_last_tree[group_index_a][:] = group_ab[:]
+                    # mutual interaction energy; we've already counted their individual binding energies
+                    group_energy[group_index_a] += InteractionEnergy(
+                        x,m,h,
+                        group_a,group_tree[group_index_a],
+                        particles_since_last_tree[group_index_a],
+                        group_b,group_tree[group_index_b],
+                        particles_since_last_tree[group_index_b]) 
+
+                    # we've got a big group, so we should probably do stuff with the tree
+                    if len(group_a) > ntree: 
+                        # if the smaller of the two is also large, let's build a whole new tree, and a whole new adventure
+                        if len(group_b) > 512: 
+                            group_tree[group_index_a] = GroupTree(group_ab, x, m, h, xbuf, mbuf, hbuf)
+                            particles_since_last_tree[group_index_a][:] = []
+                        # otherwise we want to keep the old tree from group a, and just add group b to the list of particles_since_last_tree
+                        else:  
+                            particles_since_last_tree[group_index_a] += group_b
+                    else:
+                        particles_since_last_tree[group_index_a][:] = group_ab[:]
                     
-                if len(particles_since_last_tree[group_index_a]) > ntree:
-                    group_tree[group_index_a] = pytreegrav.ConstructTree(
-                        np.take(x,group_ab,axis=0),
-                        np.take(m,group_ab),
-                        np.take(h,group_ab))
+                    if len(particles_since_last_tree[group_index_a]) > ntree:
+                        group_tree[group_index_a] = GroupTree(group_ab, x, m, h, xbuf, mbuf, hbuf)
 
-                    particles_since_last_tree[group_index_a][:] = []                    
+                        particles_since_last_tree[group_index_a][:] = []                    
                 
-                COM[group_index_a] = (ma*xa + mb*xb)/(ma+mb)
-                v_COM[group_index_a] = (ma*va + mb*vb)/(ma+mb)
+                WeightedMeanUpdate(COM, group_index_a, COM, group_index_b, mb, ma)
+                WeightedMeanUpdate(v_COM, group_index_a, v_COM, group_index_b, mb, ma)
                 masses[group_index_a] = ma + mb
                 groups.pop(group_index_b,None)
-                assigned_group[i] = group_index_a
-                assigned_group[assigned_group==group_index_b] = group_index_a
+                parent[i] = group_index_a
+                parent[group_index_b] = group_index_a ## group a stays the root so its data keeps its key
 
                 # if this new group is bound, we can delete the old bound group
                 avir = abs(2*group_KE[group_index_a]/np.abs(group_energy[group_index_a] - group_KE[group_index_a]))
@@ -253,7 +369,7 @@ def ParticleGroups(
                     largest_assigned_group[group_ab] = len(group_ab)
                     assigned_bound_group[group_ab] = group_index_a
 
-                for d in groups, particles_since_last_tree, group_tree, group_energy, group_KE, COM, v_COM, masses: # delete the data from the absorbed group
+                for d in groups, particles_since_last_tree, group_tree: # delete the data from the absorbed group
                     d.pop(group_index_b, None)
                 add_to_existing_group = True
                 
@@ -262,34 +378,60 @@ def ParticleGroups(
             
         # assuming we've added a particle to an existing group, we have to update stuff
         if add_to_existing_group: 
-            g = assigned_group[i]
+            g = parent[i]
             mgroup = masses[g]
             group_KE[g] += KE_Increment(i, m, v, u, v_COM[g], mgroup)
-            group_energy[g] += EnergyIncrement(i, groups[g][:-1], m, mgroup, x, v, u, h, v_COM[g], group_tree[g], particles_since_last_tree[g])
+            too_big = len(groups[g]) > size_cutoff
+            if too_big:
+                group_energy[g] = NOT_BOUND
+                group_tree[g] = None
+                particles_since_last_tree[g][:] = []
+            else:
+                group_energy[g] += EnergyIncrement(i, groups[g][:-1], m, mgroup, x, v, u, h, v_COM[g], group_tree[g], particles_since_last_tree[g])
             avir = abs(2*group_KE[g]/np.abs(group_energy[g] - group_KE[g]))
             if avir < alpha_crit:
                 largest_assigned_group[i] = len(groups[g])
                 assigned_bound_group[groups[g]] = g
-            v_COM[g] = (m[i]*v[i] + mgroup*v_COM[g])/(m[i]+mgroup)
+            WeightedMeanUpdate(v_COM, g, v, i, m[i], mgroup)
             masses[g] += m[i]
-            particles_since_last_tree[g].append(i)
-            if len(particles_since_last_tree[g]) > ntree:
-                group_tree[g] = pytreegrav.ConstructTree(x[groups[g]], m[groups[g]], h[groups[g]])
-                particles_since_last_tree[g][:] = []
+            if not too_big:
+                particles_since_last_tree[g].append(i)
+                if len(particles_since_last_tree[g]) > ntree:
+                    group_tree[g] = GroupTree(groups[g], x, m, h, xbuf, mbuf, hbuf)
+                    particles_since_last_tree[g][:] = []
             max_group_size = max(max_group_size, len(groups[g]))
 
     # Now assign particles to their respective bound groups
     print((assigned_bound_group == -1).sum() / len(assigned_bound_group))
-    for i in range(len(assigned_bound_group)):
-        a = assigned_bound_group[i]
-        if a < 0:
-            continue
-
-        if a in bound_groups.keys(): bound_groups[a].append(i)
-        else: bound_groups[a] = [i,]
-
+    bound = np.flatnonzero(assigned_bound_group >= 0)
+    if len(bound):
+        ## stable sort by group id keeps each group's members in density order, then split into groups
+        bound_ids = assigned_bound_group[bound]
+        order = bound_ids.argsort(kind='stable')
+        bound, bound_ids = bound[order], bound_ids[order]
+        split_points = np.flatnonzero(np.diff(bound_ids)) + 1
+        bound_groups = dict(zip(
+            bound_ids[np.r_[0, split_points]].tolist(),
+            np.split(bound, split_points))) ## intp index arrays, ready for fancy indexing downstream
+
+    assigned_group = FindRoots(parent)
     return groups, bound_groups, assigned_group
 
+def HasDuplicatePositions(x):
+    """ x - 2D array of positions (N,3)
+        returns True if any two particles share exactly the same position
+    """
+    ## hash each row's raw bytes rather than lexsorting the whole array as np.unique(axis=0) does;
+    ##  adding 0.0 turns -0.0 into 0.0 (and copies x contiguously), so rows compare by value
+    x = x + 0.0
+    rows = x.view(np.dtype((np.void, x.dtype.itemsize*x.shape[1]))).ravel()
+    seen = set()
+    for row in rows.tolist():
+        if row in seen:
+            return True ## one duplicate is enough
+        seen.add(row)
+    return False
+
 def ComputeGroups(
     x,m,rho,
     phi,hsml,
@@ -299,7 +441,8 @@ def ComputeGroups(
     max_linking_length,
     nmin,
     ntree,
-    alpha_crit):
+    alpha_crit,
+    size_cutoff=2e5):
 
     ## cast arrays to double precision
     (x, m, rho,
@@ -310,7 +453,7 @@ def ComputeGroups(
         np.float64(v), np.float64(zz))
 
     # make sure no two particles are at the same position
-    while len(np.unique(x,axis=0)) < len(x): 
+    while HasDuplicatePositions(x): 
         x *= 1+ np.random.normal(size=x.shape) * 1e-8
 
     t = time()
@@ -322,7 +465,8 @@ def ComputeGroups(
         ntree=ntree,
         alpha_crit=alpha_crit,
         cluster_ngb=cluster_ngb,
-        rmax=max_linking_length)
+        rmax=max_linking_length,
+        size_cutoff=size_cutoff)
     t = time() - t
     print("Time: %g"%t)
     
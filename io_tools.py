@@ -15,7 +15,12 @@ except ImportError:
     print("Missing: load_from_snapshot from GIZMO scripts directory.")
 
 ## from here
-from cloudphinder.clump_tools import VirialParameter
+from cloudphinder.clump_tools import PE
+
+## cloud datasets smaller than this are written contiguously, since chunking (and so compression)
+##  costs more in per-dataset metadata than it saves on them
+min_chunked_nbytes = 2**14
+chunk_nbytes = 2**20 ## larger ones are split into chunks of about this size, the default chunk cache
     
 
 ## configuration options
@@ -32,7 +37,9 @@ def make_CLI_options(
     ntree=10000,
     overwrite=False,
     units_already_physical=False,
-    max_linking_length=1e100):
+    max_linking_length=1e100,
+    size_cutoff=2e5,
+    bitshuffle=False):
     """
     Input:
     snapshots="snapshot_000.hdf5",
@@ -47,7 +54,9 @@ def make_CLI_options(
     ntree=10000,
     overwrite=False,
     units_already_physical=False,
-    max_linking_length=1e100)
+    max_linking_length=1e100,
+    size_cutoff=2e5,
+    bitshuffle=False)
 
     Output:
     arguments -> formatted dictionary of CLI arguments
@@ -69,7 +78,9 @@ def make_CLI_options(
         "--ntree": ntree,
         "--overwrite": overwrite,
         "--units_already_physical": units_already_physical,
-        "--max_linking_length": max_linking_length
+        "--max_linking_length": max_linking_length,
+        "--size_cutoff": size_cutoff,
+        "--bitshuffle": bitshuffle
         }
     return arguments
 
@@ -119,6 +130,14 @@ def parse_filepath(filepath,outputfolder):
  
     return snapnum, snapdir, snapname, outputfolder
 
+def snapshot_filesize(filepath):
+    """Total size on disk of a snapshot file or snapdir, used as a proxy for its cost."""
+    if path.isdir(filepath):
+        return sum(path.getsize(f) for f in glob(filepath+"/*.hdf5"))
+    if path.isfile(filepath):
+        return path.getsize(filepath)
+    return 0
+
 ## Input particle data from hdf5
 def read_particle_data(
     snapnum,
@@ -127,37 +146,50 @@ def read_particle_data(
     ptype,
     cluster_ngb,
     softening=1e-5,
-    units_already_physical=False):
+    units_already_physical=False,
+    nmin=None):
+    """ nmin - if given, only particles denser than nmin cm^-3 are kept, so the other
+        fields never hold the diffuse particles that parse_particle_data would discard
+    """
     
     ## create a dummy return value that the calling function can 
     ##  check against
     dummy_return = None
 
-    ## determine if there are even enough particles in this snapshot to try and
-    ##  find clusters from
-    npart = load_from_snapshot.load_from_snapshot(
-        "NumPart_Total",
-        "Header",
+    ## read the particle count and the field names from a single open of the
+    ##  (first) snapshot file, rather than one load_from_snapshot call for each
+    fname, _, _ = load_from_snapshot.check_if_filename_exists(
         snapdir,
         snapnum,
-        snapshot_name=snapname)[ptype]
+        snapshot_name=snapname)
+    if fname == 'NULL':
+        print("Snapshot file not found!")
+        return dummy_return
+    with h5py.File(fname, 'r') as f:
+        npart = f["Header"].attrs["NumPart_Total"][ptype]
+        keys = list(f["PartType%d"%ptype].keys()) if "PartType%d"%ptype in f else None
+
+    ## determine if there are even enough particles in this snapshot to try and
+    ##  find clusters from
     if npart < cluster_ngb:
         print("Not enough particles for meaningful cluster analysis!")
         return dummy_return
     
     #Read gas properties
-    keys = load_from_snapshot.load_from_snapshot(
-        "keys",
-        ptype,
-        snapdir,
-        snapnum,
-        snapshot_name=snapname)
-    if keys == 0:
+    ## (the first file of a multi-file snapshot can hold none of this type, so
+    ##  then let load_from_snapshot find a file that does)
+    if keys is None:
+        keys = load_from_snapshot.load_from_snapshot(
+            "keys",
+            ptype,
+            snapdir,
+            snapnum,
+            snapshot_name=snapname)
+    if keys == 0 or not keys:
         print("No keys found, noping out!")        
         return dummy_return
 
     # now we refine by particle density, by applying a density mask `criteria`
-    criteria = np.ones(npart,dtype=np.bool) 
     if "Density" in keys:
         rho = load_from_snapshot.load_from_snapshot(
             "Density",
@@ -195,17 +227,27 @@ def read_particle_data(
         rho = Meshoid(x,m,des_ngb=cluster_ngb).Density()
         print("Density done!")
 
+    if nmin is not None:
+        criteria = np.flatnonzero(rho*404 > nmin)
+        ## (this also keeps an empty criteria from reading as "no mask" below)
+        if not len(criteria) > cluster_ngb:
+            print('Not enough /dense/ particles, exiting...')
+            return dummy_return
+        rho = rho[criteria]
+    else:
+        criteria = np.zeros(0,dtype=int) ## an empty particle_mask is load_from_snapshot's "no mask"
+
     # now let's store all particle data that satisfies the criteria
     particle_data = {"Density": rho,'ParticleType':ptype} 
 
     ## load up the unloaded particle data
     for k in keys:
-        if not k in particle_data.keys():
+        if k not in particle_data:
             particle_data[k] = load_from_snapshot.load_from_snapshot(
                 k,ptype,
                 snapdir,snapnum,
                 snapshot_name=snapname,
-                #particle_mask=criteria,
+                particle_mask=criteria,
                 units_to_physical=(not units_already_physical))
 
     return particle_data
@@ -232,36 +274,41 @@ def parse_particle_data(particle_data,nmin,cluster_ngb):
     ## handle internal energy (and adding magnetic energy if applicable)
     u = (particle_data["InternalEnergy"] if particle_data['ParticleType'] == 0 else np.zeros_like(m))
     if "MagneticField" in particle_data:
-        energy_density_code_units = np.sum(particle_data["MagneticField"]**2,axis=1) / 8 / np.pi * 5.879e9
+        B = particle_data["MagneticField"]
+        energy_density_code_units = np.einsum('ij,ij->i', B, B) * (5.879e9 / (8*np.pi)) ## |B|^2 in one pass, no B**2 temporary
         specific_energy = energy_density_code_units / rho
         u += specific_energy 
-        ## += implies actually happens by alias but let's make it explicit
-        particle_data['InternalEnergy'] = u
+        ## += implies actually happens by alias but let's make it explicit; a u made from
+        ##  zeros isn't a field this particle type has, so don't add one
+        if "InternalEnergy" in particle_data: particle_data['InternalEnergy'] = u
 
     v = particle_data["Velocities"]
     zz = (particle_data["Metallicity"] if "Metallicity" in particle_data else np.zeros_like(m))
     sfr = particle_data["StarFormationRate"] if "StarFormationRate" in particle_data else np.zeros_like(m)
 
     # only look at dense gas (>nmin cm^-3)
-    criteria = np.arange(len(rho))[rho*404 > nmin] 
+    criteria = rho*404 > nmin
+    n_dense = int(np.count_nonzero(criteria))
 
-    print("%g particles denser than %g cm^-3" % (criteria.size,nmin))  #(np.sum(rho*147.7>nmin), nmin))
-    if not criteria.size > cluster_ngb:
+    print("%g particles denser than %g cm^-3" % (n_dense,nmin))  #(np.sum(rho*147.7>nmin), nmin))
+    if not n_dense > cluster_ngb:
         print('Not enough /dense/ particles, exiting...')
         return tuple([None]*9)
  
 
     ## apply the mask and sort by descending density
-    rho = np.take(rho, criteria, axis=0)
+    rho = rho[criteria]
     rho_order = (-rho).argsort() ## sorts by descending density
+    ## compose the mask and the sort into one index, so each array is gathered once
+    dense_order = np.flatnonzero(criteria)[rho_order]
 
-    values = [x[criteria][rho_order], m[criteria][rho_order], rho[rho_order],
-        hsml[criteria][rho_order], u[criteria][rho_order],
-        v[criteria][rho_order], zz[criteria][rho_order], sfr[criteria][rho_order]]
+    values = [x[dense_order], m[dense_order], rho[rho_order],
+        hsml[dense_order], u[dense_order],
+        v[dense_order], zz[dense_order], sfr[dense_order]]
     keys = ['Coordinates','Masses','Density','SmoothingLength',
         'InternalEnergy','Velocity','Metallicity','StarFormationRate']
     new_particle_data =  dict(zip(keys,values))
-    new_particle_data['ParticleIDs'] = particle_data['ParticleIDs'][criteria][rho_order]
+    new_particle_data['ParticleIDs'] = particle_data['ParticleIDs'][dense_order]
     return tuple([new_particle_data] + values)
 
 ## Output results to disk
@@ -272,81 +319,126 @@ def computeAndDump(
     bound_groups,
     hdf5_outfilename,
     dat_outfilename,
-    overwrite):
+    overwrite,
+    bitshuffle=False):
+    """ bitshuffle - compress the cloud datasets with hdf5plugin's bitshuffle+lz4 rather than
+        h5py's built-in lzf; reading the output back then needs hdf5plugin too
+    """
 
     print("Done grouping. Computing group properties...")
     if len(bound_groups) == 0:
         print('No groups found.')
     ## sort the clouds by descending mass
-    groupmass = np.array([m[c].sum() for c in bound_groups.values() if len(c)>3])
-    groupid = np.array([c for c in bound_groups.keys() if len(bound_groups[c])>3])
-    groupid = groupid[groupmass.argsort()[::-1]]
-
-    bound_groups = OrderedDict(zip(groupid, [bound_groups[i] for i in groupid]))
+    ## (dicts keep insertion order, so one sort of the items does it); the masses are kept for the output
+    items = []
+    for k,c in bound_groups.items():
+        if len(c)>3:
+            c = np.asarray(c,dtype=np.intp) ## a no-op for the index arrays ParticleGroups returns
+            items.append((k,c,m[c].sum()))
+    items.sort(key=lambda kcm: kcm[2], reverse=True)
+    bound_groups = {k:c for k,c,_ in items}
+    groupmass = np.array([mass for _,_,mass in items])
 
     #groupsfr = np.array([sfr[c].sum() for c in bound_groups.values() if len(c)>3])
     #print("Total SFR in clouds: ",  groupsfr.sum())
 
     # Now we dump their properties
+    ## flatten the clouds into one index array labelled by cloud, so that each property is
+    ##  a few bincount reductions over all the cloud particles rather than a loop over the clouds,
+    ##  and whatever is still done per cloud works on slices of arrays gathered once
+    nc = len(bound_groups)
+    sizes = np.array([len(c) for c in bound_groups.values()],dtype=np.intp)
+    offsets = np.cumsum(sizes) - sizes
+    idx = np.concatenate(list(bound_groups.values())) if nc else np.zeros(0,dtype=np.intp)
+    labels = np.repeat(np.arange(nc),sizes)
+    xc, mc, hc, vc, uc = x[idx], m[idx], hsml[idx], v[idx], u[idx]
+
+    def CloudSum(weights):
+        return np.bincount(labels,weights=weights,minlength=nc)
+
+    mass = groupmass
+    center = np.column_stack([CloudSum(mc*xc[:,k]) for k in range(3)])/mass[:,None]
+    dx = xc - center[labels]
+
+    ## find principle axes, from the covariance as np.cov would build it (unweighted, about
+    ##  the unweighted mean), with one batched eig over all the clouds. eig rather than eigh
+    ##  so the eigenvector signs, and so the output, are those of the per-cloud eig
+    dx0 = dx - (np.column_stack([CloudSum(dx[:,k]) for k in range(3)])/sizes[:,None])[labels]
+    cov = np.empty((nc,3,3))
+    for a in range(3):
+        for b in range(a,3):
+            cov[:,a,b] = cov[:,b,a] = CloudSum(dx0[:,a]*dx0[:,b])/(sizes-1)
+    evals,evecs = np.linalg.eig(cov)
+    evecs = evecs.transpose(0,2,1) ## eigenvectors as rows, i.e. [e1,e2,e3]
+
+    ## re-arrange so semi-major axis is always 1st
+    sort_mask = np.argsort(-evals,axis=1)
+    evals,evecs = np.take_along_axis(evals,sort_mask,axis=1),np.take_along_axis(evecs,sort_mask[:,:,None],axis=1)
+    evecs[np.all(evecs<0,axis=2)]*=-1 ## take the positive version
+
+    ## find half mass radius, assumes all particles have same mass; partitioning each cloud's
+    ##  segment about its middle element(s) gives the median in linear time, without a sort
+    r2 = np.einsum('ij,ij->i', dx, dx) ## one pass, no dx**2 temporary
+    r = np.sqrt(r2)
+    halfmass = np.empty(nc)
+    for i,(o,n) in enumerate(zip(offsets,sizes)):
+        segment = np.partition(r[o:o+n],[(n-1)//2,n//2])
+        halfmass[i] = 0.5*(segment[(n-1)//2] + segment[n//2])
+
+    ## kinetic (plus internal) energies w.r.t. each cloud's com velocity; only the
+    ##  potential energies of the virial parameters are left to compute cloud by cloud
+    v_com = np.column_stack([CloudSum(mc*vc[:,k]) for k in range(3)])/mass[:,None]
+    dv = vc - v_com[labels]
+    ke = CloudSum(mc*(0.5*np.einsum('ij,ij->i', dv, dv) + uc))
+
     bound_data = OrderedDict()
-    bound_data["Mass"] = []
-    bound_data["Center"] = []
-    bound_data["PrincipalLengths"] = []
-    bound_data["Reff"] = []
-    bound_data["HalfMassRadius"] = []
-    bound_data["NumParticles"] = []
-    bound_data["VirialParameter"] = []
-    bound_data["PrincipalAxes_e1"] = []
-    bound_data["PrincipalAxes_e2"] = []
-    bound_data["PrincipalAxes_e3"] = []
+    bound_data["Mass"] = mass
+    bound_data["Center"] = center
+    bound_data["PrincipalLengths"] = np.sqrt(np.maximum(evals,0)) ## roundoff can push a flat cloud's smallest one below 0
+    bound_data["Reff"] = np.sqrt(5./3 * CloudSum(mc*r2)/mass)
+    bound_data["HalfMassRadius"] = halfmass
+    bound_data["NumParticles"] = sizes
+    bound_data["VirialParameter"] = np.empty(nc)
+    bound_data["PrincipalAxes_e1"] = evecs[:,0]
+    bound_data["PrincipalAxes_e2"] = evecs[:,1]
+    bound_data["PrincipalAxes_e3"] = evecs[:,2]
+
+    if bitshuffle:
+        import hdf5plugin
+        cloud_compression = dict(hdf5plugin.Bitshuffle(cname='lz4'))
+    else:
+        cloud_compression = {'compression': 'lzf'}
 
     print("Outputting to: ",hdf5_outfilename)
     ## dump to HDF5
-    with h5py.File(hdf5_outfilename, 'w') as Fout:
+    with h5py.File(hdf5_outfilename, 'w', rdcc_nbytes=16*chunk_nbytes) as Fout:
 
-        i = 0
         fids = particle_data["ParticleIDs"] 
         #Store all keys in memory to reduce I/O load
-
-        for k,c in bound_groups.items():
-            ## calculate some basic properties of the clouds to output to 
-            ##  the .dat file
-            bound_data["Mass"].append(m[c].sum())
-            bound_data["NumParticles"].append(len(c))
-            bound_data["Center"].append(np.average(x[c], weights=m[c], axis=0))
-
-            ## find principle axes
-            dx = x[c] - bound_data["Center"][-1]
-
-            evals,evecs = np.linalg.eig(np.cov(dx.T))
-            evecs = evecs.T ## after transpose becomes [e1,e2], which makes sense...? lol
-
-            ## re-arrange so semi-major axis is always 1st
-            sort_mask = np.argsort(-evals)
-            evals,evecs = evals[sort_mask],evecs[sort_mask]
-            evecs[np.all(evecs<0,axis=1)]*=-1 ## take the positive version
-
-            bound_data["PrincipalLengths"].append(np.sqrt(evals))
-
-            ## find half mass radius, assumes all particles have 
-            ##  same mass
-            r = np.sum(dx**2, axis=1)**0.5
-            bound_data["HalfMassRadius"].append(np.median(r))
-        
-            bound_data["Reff"].append(np.sqrt(5./3 * np.average(r**2,weights=m[c])))
-            bound_data["VirialParameter"].append(VirialParameter(c, x, m, hsml, v, u))
-
-            cluster_id = "Cloud"+ ("%d"%i).zfill(int(np.log10(len(bound_groups))+1))
-
-            ## dump particle data for this cloud to the hdf5 file
-            Fout.create_group(cluster_id)
-            for k in particle_data.keys(): 
-                Fout[cluster_id].create_dataset('PartType'+str(ptype)+"/"+k, data = particle_data[k].take(c,axis=0))
-            i += 1
-
-            bound_data["PrincipalAxes_e1"].append(evecs[0])
-            bound_data["PrincipalAxes_e2"].append(evecs[1])
-            bound_data["PrincipalAxes_e3"].append(evecs[2])
+        clouds = []
+        id_format = "Cloud%%0%dd"%len(str(nc)) ## zero-padded to the digits of the cloud count
+
+        for i,(o,n) in enumerate(zip(offsets,sizes)):
+            bound_data["VirialParameter"][i] = np.abs(2*ke[i]/PE(slice(o,o+n), xc, mc, hc, vc, uc))
+
+            cluster_id = id_format%i
+
+            ## keep the group handles, rather than looking each cloud up by name for every field
+            clouds.append(Fout.create_group(cluster_id, track_order=False))
+
+        ## dump the particle data of each cloud to the hdf5 file one field at a time: each field is
+        ##  gathered for all the clouds at once, and each cloud then writes its slice of that
+        for k in particle_data.keys():
+            field = particle_data[k].take(idx,axis=0)
+            name = 'PartType'+str(ptype)+"/"+k
+            row_nbytes = field.itemsize*int(np.prod(field.shape[1:]))
+            for cloud, o, n in zip(clouds, offsets, sizes):
+                data = field[o:o+n]
+                if data.nbytes < min_chunked_nbytes:
+                    cloud.create_dataset(name, data = data)
+                else:
+                    chunks = (min(n, max(1, chunk_nbytes//row_nbytes)),) + field.shape[1:]
+                    cloud.create_dataset(name, data = data, chunks=chunks, **cloud_compression)
 
         print("Done grouping bound clusters!")
 
@@ -367,8 +459,16 @@ def SaveArrayDict(path, arrdict):
             header += "(%d-%d) "%(offset, offset+arrdict[k].shape[1]-1) + k + "\n"
             offset += arrdict[k].shape[1]
             
-    data = np.column_stack([b for b in arrdict.values()])
-    data = data[(-data[:,0]).argsort()] 
+    ## sort the rows by the first column, gathering each array straight into its columns
+    ##  of the table rather than stacking the table and then sorting a copy of it
+    arrays = list(arrdict.values())
+    order = (-arrays[0]).argsort()
+    data = np.empty((len(order), offset))
+    col = 0
+    for arr in arrays:
+        width = 1 if arr.ndim == 1 else arr.shape[1]
+        data[:,col:col+width] = arr[order].reshape(len(order), width)
+        col += width
     np.savetxt(path, data, header=header,  fmt='%.15g', delimiter='\t')
 
 ## read output from disk for analysis